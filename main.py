@@ -4,71 +4,113 @@ Contains the main project function
 
 This file is Copyright (c) 2021 Joshua Lenander
 """
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+
 from dateutil.relativedelta import *
+import pandas
 
 import data_io
 import plot_data
 import process_data
 
 
+def process_incident_data(incidents: pandas.DataFrame, alarm_boxes: pandas.DataFrame,
+                          fire_companies: pandas.DataFrame) -> pandas.DataFrame:
+    """Process the raw incident data into the company response time data by month.
+
+    Returns a dataframe in the format of process_data.concat_company_responses with
+    the date column converted to 'year-month' strings.
+
+    The per alarm box response times for all months are computed in a single
+    pass over the incidents.
+
+    Preconditions:
+        - incidents is a valid dataframe of the fire incidents
+        - alarm_boxes is a valid dataframe of the alarm boxes
+        - fire_companies is a valid dataframe of the fire companies
+    """
+    # Start and End bounds for the data range. Start bound is inclusive, end bound is exclusive.
+    start_date = datetime(2018, 4, 1)
+    end_date = datetime(2021, 5, 1)  # Incident data only available until 2021/05/06
+
+    # The start of every month in the data range
+    months = []
+    current_date = start_date
+    while current_date < end_date:
+        months.append(current_date)
+        current_date = current_date + relativedelta(months=+1)
+
+    # Dict mapping month to alarm box response dataframe, computed for every
+    # month at once in a single pass over the incidents
+    alarm_box_response = process_data.get_response_time_per_alarm_box_by_month(
+        incidents, alarm_boxes, months)
+
+    company_to_boxes = process_data.map_companies_to_alarm_boxes(fire_companies, alarm_boxes)
+
+    # Dict mapping the month to the company response dataframe.
+    # The months are independent, so spread the per-month company response
+    # calculations over a process pool.
+    with ProcessPoolExecutor() as executor:
+        company_responses = dict(zip(alarm_box_response, executor.map(
+            partial(process_data.calc_companies_response_time,
+                    fire_companies, company_to_boxes=company_to_boxes),
+            alarm_box_response.values())))
+
+    # Concatenate the results into one dataframe with a date column
+    company_responses_by_month = process_data.concat_company_responses(company_responses)
+
+    # Date is a pandas timestamp object and needs to be converted to a string.
+    # Also trims the day from the timestamp. The .dt accessor converts the whole
+    # column at once instead of formatting each timestamp in Python.
+    company_responses_by_month.date = (company_responses_by_month.date.dt.year.astype(str)
+                                       + '-' + company_responses_by_month.date.dt.month.astype(str))
+
+    return company_responses_by_month
+
+
 def main():
     """The main block for the project
     Running should produce an output file in output/
     """
-    firehouses = data_io.load_firehouse_data()
-    fire_companies = data_io.load_fire_companies_data()
-    alarm_boxes = data_io.load_alarm_boxes()
+    # The two OpenData downloads and the local csv read are independent,
+    # so run them concurrently and wait on the results.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        firehouses_future = executor.submit(data_io.load_firehouse_data)
+        fire_companies_future = executor.submit(data_io.load_fire_companies_data)
+        alarm_boxes_future = executor.submit(data_io.load_alarm_boxes)
+
+        firehouses = firehouses_future.result()
+        fire_companies = fire_companies_future.result()
+        alarm_boxes = alarm_boxes_future.result()
 
     ################################################################################
     # Incident dataset is large. First, use request_incidents to download the data
-    # into the ./data directory, then use load_incidents to load the data into a 
-    # dataframe. Highly recommended to get a free socrata app_token and using that 
-    # to download the incident data (site: https://opendata.cityofnewyork.us/)!
+    # into the ./data directory, then use load_incidents_cached to load the data
+    # into a dataframe (the processed result is cached as a parquet file so only
+    # the first load pays the csv parsing cost). Highly recommended to get a free
+    # socrata app_token and using that to download the incident data
+    # (site: https://opendata.cityofnewyork.us/)!
     ################################################################################
     # incidents = data_io.request_incidents()
-    # incidents = data_io.load_incidents()
+    # incidents = data_io.load_incidents_cached()
 
     ################################################################################
     # Uncomment the following block as well as loading incidents in for processing
     # of data. Otherwise, leave this commented to simply load the processed data
     # from the saved csv file.
     ################################################################################
-    # # Start and End bounds for the data range. Start bound is inclusive, end bound is exclusive.
-    # start_date = datetime(2018, 4, 1)
-    # end_date = datetime(2021, 5, 1)  # Incident data only available until 2021/05/06
-
-    # # Dict mapping month to alarm box response dataframe
-    # alarm_box_response = {}
-
-    # # Calculate each month's alarm box response
-    # current_date = start_date
-    # while current_date < end_date:
-    #     next_month = current_date + relativedelta(months=+1)
-    #     alarm_box_response[current_date] = process_data.get_response_time_per_alarm_box(incidents, alarm_boxes, start=current_date, end=next_month)
-    #     current_date = next_month
-
-    # company_to_boxes = process_data.map_companies_to_alarm_boxes(fire_companies, alarm_boxes)
-    # # Dict mapping the month to the company response dataframe
-    # company_responses = {}
-    # for date in alarm_box_response:
-    #     company_responses[date] = process_data.calc_companies_response_time(fire_companies, alarm_box_response[date], company_to_boxes)
-
-    # # Concatenate the results into one dataframe with a date column
-    # company_responses_by_month = process_data.concat_company_responses(company_responses)
-
-    # # Date is a pandas timestamp object and needs to be converted to a string.
-    # # Also trims the day from the timestamp.
-    # company_responses_by_month.date = company_responses_by_month.date.apply(lambda timestamp: f'{timestamp.year}-{timestamp.month}')
+    # company_responses_by_month = process_incident_data(incidents, alarm_boxes, fire_companies)
 
     # # Save company_responses_by_month to file
-    # data_io.save_data_frame(company_responses_by_month, 'data/processed/company_responses_by_month.csv')
+    # data_io.save_data_frame(company_responses_by_month, 'data/processed/company_responses_by_month.feather')
     ################################################################################
     # Above block processes data.
     ################################################################################
 
     # Load company_responses_by_month from file
-    company_responses_by_month = data_io.load_data_frame('data/processed/company_responses_by_month.csv')
+    company_responses_by_month = data_io.load_data_frame('data/processed/company_responses_by_month.feather')
 
     # Optionally remove outliers in response data. This will leave holes in the map for regions with no data
     company_responses_by_month = process_data.remove_outliers_companies_response(company_responses_by_month)
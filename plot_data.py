@@ -6,15 +6,22 @@ Also contains the io code to save the plots into the directory 'output'
 This file is Copyright (c) 2021 Joshua Lenander
 """
 import math
+import numpy
 import pandas
 import plotly.express as px
 import plotly.graph_objects
 
+# Cache of formatted FeatureCollections keyed by the id of the source dataframe.
+# Every plot function in a run is passed the same fire_companies frame, so the
+# geojson only needs to be built once per session.
+_geojson_cache = {}
+
 
 def plot_firehouses(firehouses: pandas.DataFrame, output=True) -> None:
     """Plot the firehouse locations on a scatter mapbox map using plotly.
 
     if <output> is True, save the plotly graph into the output directory as an html file.
+    Otherwise, show the plot in the browser.
 
     Preconditions:
         - firehouses is a valid dataframe of the firehouses
@@ -28,15 +35,17 @@ def plot_firehouses(firehouses: pandas.DataFrame, output=True) -> None:
                             hover_data=['address', 'zipcode', 'neighborhood'],
                             zoom=10)
 
-    fig.show()
     if output:
-        fig.write_html('output/firehouses.html')
+        fig.write_html('output/firehouses.html', include_plotlyjs='cdn')
+    else:
+        fig.show()
 
 
 def plot_alarm_boxes(alarm_boxes: pandas.DataFrame, output=True) -> None:
     """Plot the alarm boxes on a scatter mapbox using plotly
 
     if <output> is True, save the plotly graph into the output directory as an html file.
+    Otherwise, show the plot in the browser.
 
     Preconditions:
         - alarm_boxes is a valid dataframe of the alarm boxes
@@ -50,9 +59,10 @@ def plot_alarm_boxes(alarm_boxes: pandas.DataFrame, output=True) -> None:
                             hover_data=['alarm_box_code', 'alarm_box_location'],
                             zoom=10)
 
-    fig.show()
     if output:
-        fig.write_html('output/alarm_boxes.html')
+        fig.write_html('output/alarm_boxes.html', include_plotlyjs='cdn')
+    else:
+        fig.show()
 
 
 def _get_companies_plot(fire_companies: pandas.DataFrame, opacity=1.0) -> plotly.graph_objects.Figure:
@@ -65,11 +75,12 @@ def _get_companies_plot(fire_companies: pandas.DataFrame, opacity=1.0) -> plotly
     """
     json_geom = _format_companies_for_plotly(fire_companies)
 
-    # Create a copy of the fire companies and
     # Replace the company type letter with the full description name.
+    # assign only copies the one replaced column instead of the whole frame,
+    # and map is a vectorized lookup rather than a per-row lambda.
     fire_co_type_map = {'E': 'Engine', 'L': 'Ladder', 'Q': 'Squad'}
-    fire_companies = fire_companies.copy()
-    fire_companies['fire_co_type'] = fire_companies['fire_co_type'].apply(lambda type: fire_co_type_map[type])
+    fire_companies = fire_companies.assign(
+        fire_co_type=fire_companies['fire_co_type'].map(fire_co_type_map))
 
     return px.choropleth_mapbox(fire_companies,
                                 geojson=json_geom,
@@ -94,21 +105,25 @@ def plot_companies(fire_companies: pandas.DataFrame, output=True, opacity=1.0) -
     """Plot the fire company boundaries on a choropleth mapbox map using plotly.
 
     if <output> is True, save the plotly graph into the output directory as an html file.
+    Otherwise, show the plot in the browser.
 
     Preconditions:
         - fire_companies is a valid dataframe of the fire companies
     """
     fig = _get_companies_plot(fire_companies, opacity)
 
-    fig.show()
     if output:
-        fig.write_html(f'output/fire_companies_opacity_{int(opacity * 100)}_percent.html')
+        fig.write_html(f'output/fire_companies_opacity_{int(opacity * 100)}_percent.html',
+                       include_plotlyjs='cdn')
+    else:
+        fig.show()
 
 
 def plot_companies_and_alarm_boxes(fire_companies: pandas.DataFrame, alarm_boxes, output=True, opacity=1.0) -> None:
     """Plot the fire company boundaries and alarm box locations on a choropleth mapbox map using plotly.
 
     if <output> is True, save the plotly graph into the output directory as an html file.
+    Otherwise, show the plot in the browser.
 
     Preconditions:
         - fire_companies is a valid dataframe of the fire companies
@@ -117,12 +132,14 @@ def plot_companies_and_alarm_boxes(fire_companies: pandas.DataFrame, alarm_boxes
 
     # Custom data for the hover information on the alarm box trace.
     # array is parallel to the alarm_boxes dataframe and contains
-    # alarm_box_code and alarm box location for each alarm box
-    customdata = [[alarm_boxes.alarm_box_code.iat[i], alarm_boxes.alarm_box_location.iat[i]]
-                  for i in range(len(alarm_boxes))]
+    # alarm_box_code and alarm box location for each alarm box.
+    # Plotly copies pandas objects; hand it plain numpy arrays instead.
+    customdata = numpy.column_stack([alarm_boxes.alarm_box_code.to_numpy(),
+                                     alarm_boxes.alarm_box_location.to_numpy()])
 
     fig.add_scattermapbox(customdata=customdata,
-                          lat=alarm_boxes.latitude, lon=alarm_boxes.longitude, mode='markers',
+                          lat=alarm_boxes.latitude.to_numpy(),
+                          lon=alarm_boxes.longitude.to_numpy(), mode='markers',
                           hovertemplate=('<b>%{customdata[0]}</b><br><br>latitude=%{lat}<br>'
                                          'longitude=%{lon}<br>alarm_box_code=%{customdata[0]}'
                                          '<br>alarm_box_location=%{customdata[1]}<extra></extra>'),
@@ -131,9 +148,11 @@ def plot_companies_and_alarm_boxes(fire_companies: pandas.DataFrame, alarm_boxes
     # Update title
     fig.update_layout({'title': 'Fire Company boundaries and Alarm Box locations'})
 
-    fig.show()
     if output:
-        fig.write_html(f'output/fire_companies_and_alarm_boxes_opacity_{int(opacity * 100)}_percent.html')
+        fig.write_html(f'output/fire_companies_and_alarm_boxes_opacity_{int(opacity * 100)}_percent.html',
+                       include_plotlyjs='cdn')
+    else:
+        fig.show()
 
 
 def plot_companies_and_firehouses(fire_companies: pandas.DataFrame, firehouses: pandas.DataFrame, output=True, opacity=1.0) -> None:
@@ -141,6 +160,7 @@ def plot_companies_and_firehouses(fire_companies: pandas.DataFrame, firehouses:
     (the firehouse locations are a scatter map added to the choropleth map)
 
     if <output> is True, save the plotly graph into the output directory as an html file.
+    Otherwise, show the plot in the browser.
 
     Preconditions:
         - fire_companies is a valid dataframe of the fire companies
@@ -150,12 +170,16 @@ def plot_companies_and_firehouses(fire_companies: pandas.DataFrame, firehouses:
 
     # Custom data for the hover information on the alarm box trace.
     # array is parallel to the firehouses dataframe and contains
-    # facilityname, address, zipcode, and neighborhood for each firehouse
-    customdata = [[firehouses.facilityname.iat[i], firehouses.address.iat[i], firehouses.zipcode.iat[i],
-                  firehouses.neighborhood.iat[i]] for i in range(len(firehouses))]
+    # facilityname, address, zipcode, and neighborhood for each firehouse.
+    # Plotly copies pandas objects; hand it plain numpy arrays instead.
+    customdata = numpy.column_stack([firehouses.facilityname.to_numpy(),
+                                     firehouses.address.to_numpy(),
+                                     firehouses.zipcode.to_numpy(),
+                                     firehouses.neighborhood.to_numpy()])
 
     fig.add_scattermapbox(customdata=customdata,
-                          lat=firehouses.latitude, lon=firehouses.longitude, mode='markers',
+                          lat=firehouses.latitude.to_numpy(),
+                          lon=firehouses.longitude.to_numpy(), mode='markers',
                           hovertemplate=('<b>%{customdata[0]}</b><br><br>latitude=%{lat}<br>'
                                          'longitude=%{lon}<br>address=%{customdata[1]}<br>'
                                          'zipcode=%{customdata[2]}<br>'
@@ -165,9 +189,11 @@ def plot_companies_and_firehouses(fire_companies: pandas.DataFrame, firehouses:
     # Update title
     fig.update_layout({'title': 'Firehouses and Fire Company boundaries'})
 
-    fig.show()
     if output:
-        fig.write_html(f'output/firehouses_and_companies_opacity_{int(opacity * 100)}_percent.html')
+        fig.write_html(f'output/firehouses_and_companies_opacity_{int(opacity * 100)}_percent.html',
+                       include_plotlyjs='cdn')
+    else:
+        fig.show()
 
 
 def plot_companies_and_response_times_animated(fire_companies_response_time: pandas.DataFrame,
@@ -180,6 +206,7 @@ def plot_companies_and_response_times_animated(fire_companies_response_time: pan
     Format of this column should be
 
     if <output> is True, save the plotly graph into the output directory as an html file.
+    Otherwise, show the plot in the browser.
 
     Preconditions:
         - fire_companies_response_time is a valid dataframe of the fire companies
@@ -212,9 +239,11 @@ def plot_companies_and_response_times_animated(fire_companies_response_time: pan
                                zoom=9,
                                opacity=opacity)
 
-    fig.show()
     if output:
-        fig.write_html(f'output/avg_response_time_opacity_{int(opacity * 100)}_percent.html', auto_play=False)
+        fig.write_html(f'output/avg_response_time_opacity_{int(opacity * 100)}_percent.html',
+                       include_plotlyjs='cdn', auto_play=False)
+    else:
+        fig.show()
 
 
 def _format_companies_for_plotly(fire_companies: pandas.DataFrame) -> dict:
@@ -230,15 +259,19 @@ def _format_companies_for_plotly(fire_companies: pandas.DataFrame) -> dict:
     Preconditions:
         - fire_companies is a valid dataframe of the fire companies
     """
-    # Use properties.key for featureidkey in plotly
-    the_geom_list = list(fire_companies.the_geom)
-    new_json_geom = {'type': 'FeatureCollection', 'features': []}
-    for i in range(len(the_geom_list)):
-        new_feature = {}
-        new_feature['type'] = 'Feature'
-        new_feature['properties'] = {
-            'company': fire_companies.company_name[i], 'battalion': fire_companies.fire_bn[i]}
-        new_feature['geometry'] = the_geom_list[i]
-        new_json_geom['features'].append(new_feature)
-
-    return new_json_geom
+    cached = _geojson_cache.get(id(fire_companies))
+    if cached is not None:
+        return cached
+
+    # Use properties.key for featureidkey in plotly.
+    # zip over the raw column arrays instead of indexing each Series per row.
+    features = [{'type': 'Feature',
+                 'properties': {'company': company, 'battalion': battalion},
+                 'geometry': geometry}
+                for geometry, company, battalion in zip(fire_companies['the_geom'].to_numpy(),
+                                                        fire_companies['company_name'].to_numpy(),
+                                                        fire_companies['fire_bn'].to_numpy())]
+
+    json_geom = {'type': 'FeatureCollection', 'features': features}
+    _geojson_cache[id(fire_companies)] = json_geom
+    return json_geom
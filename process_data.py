@@ -7,52 +7,111 @@ This file is Copyright (c) 2021 Joshua Lenander
 """
 from datetime import datetime
 
+import numpy
 import pandas
-from shapely.geometry import MultiPolygon, Point, Polygon
+from shapely.geometry import MultiPolygon, Point, shape
+from shapely.strtree import STRtree
+from shapely.vectorized import contains
+
+# Cache of already converted geojson multipolygons keyed by the id of the
+# input dict. The same fire company geometries are converted on every
+# map_companies_to_alarm_boxes call, so repeat calls in one session reuse
+# the shapely objects built the first time.
+_geom_cache: dict[int, MultiPolygon] = {}
 
 
 def get_response_time_per_alarm_box(incidents: pandas.DataFrame, alarm_boxes: pandas.DataFrame,
-                                    start=datetime(2016, 1, 1), end=datetime(2021, 5, 6)) -> pandas.DataFrame:
+                                    start=None, end=None) -> pandas.DataFrame:
     """Extract the sum of the response times (in seconds) for each alarm box in alarm_boxes
     restrict data to times after <start> and before <end>.
     <start> bound is inclusive
     <end> bound is exclusive
+    A bound of None is not applied; pass an already sliced dataframe with both
+    bounds None to skip the date filtering entirely.
 
     Returns a dataframe with columns alarm_box_code, alarm_box_location, latitude, longitude
         incident_count, and response_time_sum
 
     Preconditions:
-        - start < end
+        - start is None or end is None or start < end
     """
-
-    # Create a series mapping the alarm box codes to an integer of the incident count
-    incident_count = pandas.Series(data=0, index=alarm_boxes.alarm_box_code)
-
-    # Create a series mapping the alarm box codes to a sum of the incident response times
-    incident_rspns_sum = pandas.Series(data=0, index=alarm_boxes.alarm_box_code)
-
-    # Locate the specific range of incidents
-    incidents_in_range = incidents.loc[incidents.incident_datetime >= start].loc[incidents.incident_datetime < end]
-
-    for incident in incidents_in_range.itertuples():
-        code = incident.alarm_box_code
-
-        # Ignore alarm boxes we do not have location data for
-        if code in incident_count:
-            incident_count[code] += 1
-            incident_rspns_sum[code] += incident.incident_response_seconds_qy
+    # Locate the specific range of incidents with one combined mask, so the
+    # frame is filtered (and copied) at most once. Comparing the raw
+    # datetime64 array keeps both comparisons in numpy C loops.
+    incidents_in_range = incidents
+    if start is not None or end is not None:
+        datetimes = incidents['incident_datetime'].to_numpy()
+        in_range = numpy.ones(len(incidents), dtype=bool)
+        if start is not None:
+            in_range &= datetimes >= numpy.datetime64(start)
+        if end is not None:
+            in_range &= datetimes < numpy.datetime64(end)
+        incidents_in_range = incidents.loc[in_range]
+
+    # Encode each incident's alarm box code as its integer position in alarm_boxes.
+    # Boxes we do not have location data for encode as -1 and are dropped.
+    positions = pandas.Categorical(incidents_in_range.alarm_box_code,
+                                   categories=alarm_boxes.alarm_box_code).codes
+    seconds = incidents_in_range.incident_response_seconds_qy.to_numpy()
+    known = positions >= 0
+    positions = positions[known]
+
+    # Count and sum the response times per alarm box with two bincount passes
+    # over the raw integer codes (plain C loops, no per-group dispatch).
+    incident_count = numpy.bincount(positions, minlength=len(alarm_boxes))
+    incident_rspns_sum = numpy.bincount(positions, weights=seconds[known],
+                                        minlength=len(alarm_boxes))
 
     alarm_box_response = pandas.DataFrame({
         'alarm_box_code': alarm_boxes.alarm_box_code,
         'alarm_box_location': alarm_boxes.alarm_box_location,
         'latitude': alarm_boxes.latitude,
         'longitude': alarm_boxes.longitude,
-        'incident_count': incident_count.values,
-        'response_time_sum': incident_rspns_sum.values
+        'incident_count': incident_count,
+        'response_time_sum': incident_rspns_sum
     })
 
     return alarm_box_response
 
+
+def get_response_time_per_alarm_box_by_month(incidents: pandas.DataFrame, alarm_boxes: pandas.DataFrame,
+                                             months: list[datetime]) -> dict[datetime, pandas.DataFrame]:
+    """Extract the incident counts and response time sums per alarm box for every
+    month in <months> with a single pass over incidents.
+
+    Returns a dict mapping the start of each month to a dataframe in the format
+    of get_response_time_per_alarm_box. Incidents outside <months> are ignored.
+
+    Preconditions:
+        - every datetime in months is the first day of a month
+    """
+    # Bucket every incident by month and alarm box in one grouped pass instead
+    # of filtering and aggregating the frame once per month.
+    grouped = incidents.groupby(
+        [pandas.Grouper(key='incident_datetime', freq='MS'), 'alarm_box_code'],
+        observed=True)['incident_response_seconds_qy'].agg(['count', 'sum'])
+
+    # Align to the requested month grid and the alarm_boxes order, filling months
+    # and boxes with no incidents with 0. This also drops alarm boxes we do not
+    # have location data for.
+    full_index = pandas.MultiIndex.from_product(
+        [pandas.DatetimeIndex(months), alarm_boxes.alarm_box_code])
+    grouped = grouped.reindex(full_index, fill_value=0)
+
+    alarm_box_responses = {}
+    for month in months:
+        month_group = grouped.xs(month, level=0)
+        alarm_box_responses[month] = pandas.DataFrame({
+            'alarm_box_code': alarm_boxes.alarm_box_code,
+            'alarm_box_location': alarm_boxes.alarm_box_location,
+            'latitude': alarm_boxes.latitude,
+            'longitude': alarm_boxes.longitude,
+            'incident_count': month_group['count'].values,
+            'response_time_sum': month_group['sum'].values
+        })
+
+    return alarm_box_responses
+
 # NOTE no longer correct for this implementation
 # def remove_outliers_average_response(avg_response: pandas.DataFrame, min_incident_count=3) -> pandas.DataFrame:
 #     """Returns a new average response dataframe with outliers removed
@@ -76,13 +135,11 @@ def remove_outliers_companies_response(companies_response: pandas.DataFrame) ->
     Preconditions:
         - companies_response is a dataframe in the format specified by calc_companies_response_time
     """
-    lower_bound_indices = companies_response.loc[companies_response.response_times < 1.0].index
-    upper_bound_indices = companies_response.loc[companies_response.response_times > 2500.0].index
-
-    companies_response = companies_response.drop(lower_bound_indices)
-    companies_response = companies_response.drop(upper_bound_indices)
-
-    return companies_response
+    # Select the rows to keep with one combined mask, so the frame is scanned
+    # and copied once instead of once per bound by the two drop calls.
+    in_bounds = ((companies_response.response_times >= 1.0)
+                 & (companies_response.response_times <= 2500.0))
+    return companies_response.loc[in_bounds]
 
 
 def convert_geojson_to_shapely(multipolygon: dict) -> MultiPolygon:
@@ -91,13 +148,15 @@ def convert_geojson_to_shapely(multipolygon: dict) -> MultiPolygon:
     Preconditions:
         - multipolygon is a geojson formatted multipolygon dictionary
     """
-    geojson_polygons = multipolygon['coordinates']
-    shapely_polygons = []
-    for json_polygon in geojson_polygons:
-        shapely_polygons.append(
-            Polygon(json_polygon[0], holes=json_polygon[1:]))
+    cached = _geom_cache.get(id(multipolygon))
+    if cached is not None:
+        return cached
 
-    return MultiPolygon(shapely_polygons)
+    # shapely's own geojson constructor builds the rings without a Python
+    # per-polygon loop
+    geometry = shape(multipolygon)
+    _geom_cache[id(multipolygon)] = geometry
+    return geometry
 
 
 def calc_companies_response_time(fire_companies: pandas.DataFrame, alarm_box_response: pandas.DataFrame,
@@ -118,27 +177,30 @@ def calc_companies_response_time(fire_companies: pandas.DataFrame, alarm_box_res
         - company_to_boxes is a dictionary mapping the fire companies name to a list of alarm boxes
             located within that company. See map_companies_to_alarm_boxes
     """
-    # DataFrame connecting company name to the average response times for the company and to incident counts.
-    company_response_times = pandas.DataFrame(data={'response_times': 0.0, 'incident_count': 0},
-                                              index=list(company_to_boxes.keys()), columns=['response_times', 'incident_count'])
-
-    for company_name in company_to_boxes:
-        # The segment of the alarm box response times corresponding to the company
-        company_response_segment = alarm_box_response.loc[alarm_box_response['alarm_box_code'].isin(
-            company_to_boxes[company_name])]
-
-        # Avoid divide by 0
-        if company_response_segment.response_time_sum.sum() > 0:
-            avg_time = company_response_segment.response_time_sum.sum() / company_response_segment.incident_count.sum()
-            company_response_times.response_times.at[company_name] = avg_time
-
-        company_response_times.incident_count.at[company_name] = company_response_segment.incident_count.sum()
+    # Reverse map of alarm box code to the company containing it
+    box_to_company = {box: company for company, boxes in company_to_boxes.items()
+                      for box in boxes}
+
+    # Tag every alarm box row with its company and aggregate all companies in a
+    # single grouped pass instead of rescanning the frame once per company.
+    # Boxes outside every company boundary map to NaN and are dropped by groupby.
+    companies = alarm_box_response['alarm_box_code'].map(box_to_company)
+    stats = alarm_box_response.groupby(companies).agg(
+        response_time_sum=('response_time_sum', 'sum'),
+        incident_count=('incident_count', 'sum'))
+    stats = stats.reindex(list(company_to_boxes.keys()), fill_value=0)
+
+    # Average response time per company; clamping a 0 count to 1 avoids a
+    # divide by 0 and leaves companies with no incidents at 0.0.
+    # numpy.maximum is a single ufunc pass, unlike Series.replace which
+    # rebuilds the column to swap the zeros.
+    avg_times = stats.response_time_sum.to_numpy() / numpy.maximum(stats.incident_count.to_numpy(), 1)
 
     firehouse_copy = fire_companies.copy()
     # Drop unused field the_geom
     firehouse_copy = firehouse_copy.drop(columns='the_geom')
-    firehouse_copy['response_times'] = company_response_times.response_times.values
-    firehouse_copy['incident_count'] = company_response_times.incident_count.values
+    firehouse_copy['response_times'] = avg_times
+    firehouse_copy['incident_count'] = stats.incident_count.values
     return firehouse_copy
 
 
@@ -150,43 +212,46 @@ def map_companies_to_alarm_boxes(fire_companies: pandas.DataFrame, alarm_boxes:
         - fire_companies is a valid dataframe of the fire companies
         - alarm_boxes is a valid dataframe of the alarm boxes
     """
-    # dict of company name to the list of alarm box names
-    company_to_boxes = {row.company_name: []
-                        for _, row in fire_companies.iterrows()}
     # dict of company name to the shapely multipolygon shape of the boundary
     company_boundaries = _get_shapely_geometry(fire_companies)
-    # dict of alarm box point codes to the alarm box point location
-    alarm_box_locations = {row.alarm_box_code: Point(
-        row.longitude, row.latitude) for _, row in alarm_boxes.iterrows()}
-
-    for company_name in company_to_boxes.keys():
-        company_to_boxes[company_name] = _find_alarm_boxes_in_boundary(
-            alarm_box_locations, company_boundaries[company_name])
 
-        # Remove the boxes that were found in the boundary from the dictionary
-        # (each box can only be in one space)
-        for box_code in company_to_boxes[company_name]:
-            alarm_box_locations.pop(box_code)
+    # Parallel arrays of the alarm box codes and coordinates
+    codes = alarm_boxes['alarm_box_code'].to_numpy()
+    longitudes = alarm_boxes['longitude'].to_numpy(dtype='float64')
+    latitudes = alarm_boxes['latitude'].to_numpy(dtype='float64')
+
+    # Spatial index over the alarm box points. Querying the tree with a boundary
+    # returns only the points whose bounding box intersects it, so the exact
+    # containment test runs on a handful of candidates per company instead of
+    # every (company, box) pair.
+    points = [Point(longitude, latitude)
+              for longitude, latitude in zip(longitudes, latitudes)]
+    tree = STRtree(points)
+    index_of_point = {id(point): i for i, point in enumerate(points)}
+
+    # Mask of the boxes already claimed by a company
+    # (each box can only be in one space)
+    claimed = numpy.zeros(len(codes), dtype=bool)
+
+    company_to_boxes = {}
+    for company_name, boundary in company_boundaries.items():
+        # Indices of the unclaimed candidate boxes, in alarm_boxes order
+        candidates = numpy.sort(numpy.fromiter(
+            (index_of_point[id(point)] for point in tree.query(boundary)), dtype='int64'))
+        candidates = candidates[~claimed[candidates]]
+
+        # One batched point-in-polygon call over all candidates; vectorized
+        # contains prepares the geometry internally and tests the coordinate
+        # arrays in C instead of crossing into GEOS once per point
+        contained = candidates[contains(
+            boundary, longitudes[candidates], latitudes[candidates])]
+
+        claimed[contained] = True
+        company_to_boxes[company_name] = codes[contained].tolist()
 
     return company_to_boxes
 
 
-def _find_alarm_boxes_in_boundary(boxes: dict[str, Point], boundary: MultiPolygon) -> list[str]:
-    """Returns the list of alarm boxes codes that are within the boundary
-
-    Helper for map_companies_to_alarm_boxes
-
-    Preconditions:
-        - Each Point object in boxes corresponds to it's key's alarm box position.
-    """
-    contained_list = []
-    for alarm_box in boxes:
-        if boundary.contains(boxes[alarm_box]):
-            contained_list.append(alarm_box)
-
-    return contained_list
-
-
 def _get_shapely_geometry(fire_companies: pandas.DataFrame) -> dict[str, MultiPolygon]:
     """Return a dictionary mapping the company name to the shapely multipolygon object
 
@@ -195,16 +260,15 @@ def _get_shapely_geometry(fire_companies: pandas.DataFrame) -> dict[str, MultiPo
     Preconditions:
         - fire_companies is a valid dataframe of the fire companies
     """
-    shapes = {}
-    for _, row in fire_companies.iterrows():
-        shapes[row.company_name] = convert_geojson_to_shapely(row.the_geom)
-    return shapes
+    return {name: convert_geojson_to_shapely(geometry)
+            for name, geometry in zip(fire_companies['company_name'].to_numpy(),
+                                      fire_companies['the_geom'].to_numpy())}
 
 
 def concat_company_responses(companies_response_by_month: dict[datetime, pandas.DataFrame]) -> pandas.DataFrame:
     """Return a single dataframe of company response data by month
     Returned dataframe contains a column "date" that points to what date the data is for.
-    Modifies each original dataframe to include the date column.
+    The original dataframes are not modified.
 
     Input dictionary companies_response_times_by_month has a datetime object as the key pointing to a
     dataframe of the format specified in calc_companies_response_time.
@@ -212,10 +276,8 @@ def concat_company_responses(companies_response_by_month: dict[datetime, pandas.
 
     Used for plotly animation of the response time data
     """
-
-    for date in companies_response_by_month:
-        # A new column 'date' containing *date* is added to the dataframe pointed to by *date*
-        # *date* is a datetime object
-        companies_response_by_month[date]['date'] = date
-
-    return pandas.concat([companies_response_by_month[date] for date in companies_response_by_month], ignore_index=True)
+    # assign returns a copy with the date column instead of mutating the caller's
+    # dataframes; copy=False lets concat build the result in one allocation.
+    return pandas.concat((frame.assign(date=date)
+                          for date, frame in companies_response_by_month.items()),
+                         ignore_index=True, copy=False)